@@ -0,0 +1,66 @@
+# cython: language_level=3, boundscheck=False, wraparound=False, cdivision=True
+"""
+A Cython version of the fused GADGET-kernel density loop, for when numba is
+not available. It is compiled on first import by sphtests/sph_cython.py.
+"""
+
+import numpy as np
+
+cimport cython
+from cython.parallel cimport prange
+from libc.math cimport fabs
+
+
+cdef inline double gadget_poly(double factor) noexcept nogil:
+    cdef double factor2, one_minus_factor
+
+    if factor <= 0.5:
+        factor2 = factor * factor
+        return 1 - 6 * factor2 + 6 * factor2 * factor
+    elif factor <= 1:
+        one_minus_factor = 1 - factor
+        return 2 * one_minus_factor * one_minus_factor * one_minus_factor
+    else:
+        return 0.
+
+
+cdef double compute_density(const double *pos, const double *h, long N, long i) noexcept nogil:
+    """
+    The GADGET-kernel density at particle i.
+    """
+    cdef long j
+    cdef double acc = 0.
+    cdef double inv_h = 1. / h[i]
+
+    for j in range(N):
+        acc += gadget_poly(fabs(pos[i] - pos[j]) * inv_h)
+
+    return acc * 4. * inv_h / 3.
+
+
+cdef void compute_all_densities(const double *pos, const double *h, long N, double *out) noexcept nogil:
+    cdef long i
+
+    for i in prange(N, schedule="static"):
+        out[i] = compute_density(pos, h, N, i)
+
+
+def density_all(positions, h):
+    """
+    Calculates the SPH density at every particle position with the GADGET
+    kernel.
+
+    + positions are the particle positions (float64 array),
+    + h are the smoothing lengths of the particles (float64 array).
+    """
+    cdef const double[::1] pos_view = np.ascontiguousarray(positions, dtype=np.float64)
+    cdef const double[::1] h_view = np.ascontiguousarray(h, dtype=np.float64)
+    cdef long N = pos_view.shape[0]
+
+    out = np.empty(N, dtype=np.float64)
+    cdef double[::1] out_view = out
+
+    if N > 0:
+        compute_all_densities(&pos_view[0], &h_view[0], N, &out_view[0])
+
+    return out
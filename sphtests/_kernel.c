@@ -0,0 +1,115 @@
+/*
+ * The GADGET-kernel sum over one particle's separations,
+ *
+ *     (4 / 3h) sum_j P(r_j / h),
+ *
+ * with P the polynomial part of the kernel (see sph.gadget_kernel_poly).
+ * On CPUs with AVX2 four separations are handled at a time: both pieces of
+ * the spline are evaluated and then selected with blends, rather than
+ * branching on each element. The AVX2 version is chosen at run time, so the
+ * extension still works (with the scalar loop) on older CPUs.
+ */
+
+#include "_kernel.h"
+
+#if defined(__x86_64__) && (defined(__GNUC__) || defined(__clang__))
+#define HAVE_AVX2_DISPATCH 1
+#include <immintrin.h>
+#endif
+
+
+static inline double gadget_poly(double factor)
+{
+    double one_minus_factor;
+
+    if (factor <= 0.5) {
+        return 1 - 6 * factor * factor + 6 * factor * factor * factor;
+    } else if (factor <= 1) {
+        one_minus_factor = 1 - factor;
+        return 2 * one_minus_factor * one_minus_factor * one_minus_factor;
+    } else {
+        return 0.;
+    }
+}
+
+
+static double gadget_poly_sum_scalar(const double *separations, size_t n, double inv_h)
+{
+    size_t j;
+    double acc = 0.;
+
+    for (j = 0; j < n; j++) {
+        acc += gadget_poly(separations[j] * inv_h);
+    }
+
+    return acc;
+}
+
+
+#ifdef HAVE_AVX2_DISPATCH
+__attribute__((target("avx2")))
+static double gadget_poly_sum_avx2(const double *separations, size_t n, double inv_h)
+{
+    const __m256d inv_h_v = _mm256_set1_pd(inv_h);
+    const __m256d zero = _mm256_setzero_pd();
+    const __m256d one = _mm256_set1_pd(1.);
+    const __m256d two = _mm256_set1_pd(2.);
+    const __m256d six = _mm256_set1_pd(6.);
+    const __m256d half = _mm256_set1_pd(0.5);
+
+    __m256d acc = zero;
+    double lanes[4];
+    size_t j;
+
+    for (j = 0; j + 4 <= n; j += 4) {
+        __m256d factor = _mm256_mul_pd(_mm256_loadu_pd(separations + j), inv_h_v);
+        __m256d factor2 = _mm256_mul_pd(factor, factor);
+        __m256d one_minus_factor = _mm256_sub_pd(one, factor);
+
+        /* 1 - 6 q^2 + 6 q^3 = 1 + 6 q^2 (q - 1) */
+        __m256d inner = _mm256_add_pd(
+            one,
+            _mm256_mul_pd(_mm256_mul_pd(six, factor2), _mm256_sub_pd(factor, one))
+        );
+        /* 2 (1 - q)^3 */
+        __m256d outer = _mm256_mul_pd(
+            _mm256_mul_pd(two, one_minus_factor),
+            _mm256_mul_pd(one_minus_factor, one_minus_factor)
+        );
+
+        __m256d is_inner = _mm256_cmp_pd(factor, half, _CMP_LE_OQ);
+        __m256d is_inside = _mm256_cmp_pd(factor, one, _CMP_LE_OQ);
+
+        __m256d poly = _mm256_blendv_pd(
+            _mm256_blendv_pd(zero, outer, is_inside),
+            inner,
+            is_inner
+        );
+
+        acc = _mm256_add_pd(acc, poly);
+    }
+
+    _mm256_storeu_pd(lanes, acc);
+
+    return lanes[0] + lanes[1] + lanes[2] + lanes[3]
+        + gadget_poly_sum_scalar(separations + j, n - j, inv_h);
+}
+#endif
+
+
+double gadget_kernel_sum(const double *separations, size_t n, double inv_h)
+{
+    double acc;
+
+#ifdef HAVE_AVX2_DISPATCH
+    if (__builtin_cpu_supports("avx2")) {
+        acc = gadget_poly_sum_avx2(separations, n, inv_h);
+    } else {
+        acc = gadget_poly_sum_scalar(separations, n, inv_h);
+    }
+#else
+    acc = gadget_poly_sum_scalar(separations, n, inv_h);
+#endif
+
+    return acc * 4. * inv_h / 3.;
+}
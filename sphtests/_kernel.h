@@ -0,0 +1,8 @@
+#ifndef SPHTESTS_KERNEL_H
+#define SPHTESTS_KERNEL_H
+
+#include <stddef.h>
+
+double gadget_kernel_sum(const double *separations, size_t n, double inv_h);
+
+#endif
@@ -0,0 +1,28 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+A wrapper around the C GADGET-kernel sum in _kernel.c, which uses AVX2 where
+the CPU supports it. It is compiled on first import by sphtests/sph_cython.py.
+"""
+
+import numpy as np
+
+
+cdef extern from "_kernel.h":
+    double gadget_kernel_sum(const double *separations, size_t n, double inv_h) nogil
+
+
+def density_row(separations, double h):
+    """
+    The GADGET-kernel density of a single particle, from the separations to
+    each of the other particles and its smoothing length h.
+
+    + separations, the (non-negative) separations (float64 array),
+    + h the smoothing length of the particle.
+    """
+    cdef const double[::1] view = np.ascontiguousarray(separations, dtype=np.float64)
+    cdef size_t n = view.shape[0]
+
+    if n == 0:
+        return 0.
+
+    return gadget_kernel_sum(&view[0], n, 1. / h)
@@ -1,4 +1,6 @@
-from sphtests import gadget, pressure_entropy, sph
+import numpy as np
+
+from sphtests import gadget, pressure_entropy, sph, sph_cuda, sph_numba
 
 
 class GadgetData(object):
@@ -14,11 +16,22 @@ class GadgetData(object):
             eta=5,
             silent=False,
             gamma=4./3.,
-            kernel=sph.gadget_kernel
+            kernel=sph.gadget_kernel,
+            dtype=np.float64,
+            backend="numpy"
         ):
         """
         Please specify one of _either_ energies or adiabats.
 
+        dtype is the precision that the positions, smoothing lengths and
+        densities are stored and computed in. Use np.float32 to halve the
+        memory traffic of the pairwise passes; the energies and pressures are
+        always kept in float64.
+
+        backend is either "numpy" or "cupy". With "cupy" the pairwise passes
+        for the smoothing lengths and densities run on the GPU, and their
+        results are copied back in to numpy arrays.
+
         After creation, the properties can be accessed through:
 
         + GadgetData.smoothing_lengths,
@@ -36,13 +49,49 @@ class GadgetData(object):
                 "Only provide one."
             )
 
-        self.positions = positions
+        if backend == "cupy" and sph.cupy is None:
+            raise ImportError("The cupy backend requires cupy to be installed.")
+        elif backend not in ["numpy", "cupy"]:
+            raise AttributeError(
+                "Unknown backend {}, please use numpy or cupy.".format(backend)
+            )
+
+        self.backend = backend
+
+        # Each particle property is kept in its own contiguous array.
+        self.positions = np.ascontiguousarray(positions, dtype=dtype)
         self.energies = energies
         self.adiabats = adiabats
+
+        if energies is not None:
+            self.energies = np.ascontiguousarray(energies, dtype=np.float64)
+        if adiabats is not None:
+            self.adiabats = np.ascontiguousarray(adiabats, dtype=np.float64)
+
         self.eta = eta
         self.kernel = kernel
         self.gamma = gamma
-        
+
+        fused = (
+            energies is not None
+            and kernel is sph.gadget_kernel
+            and backend == "numpy"
+            and sph_numba.NUMBA_AVAILABLE
+        )
+
+        if fused:
+            # The smoothing lengths, densities and pressures only depend on
+            # each other, so with numba they are found in a single pass.
+            if not silent: print("Calculating smoothing lengths, densities and pressures")
+            self.smoothing_lengths, self.densities, self.pressures = gadget.compute_all(
+                self.positions,
+                self.energies,
+                eta=self.eta,
+                gamma=self.gamma
+            )
+
+            return
+
         if not silent: print("Calculating smoothing lengths")
         self.smoothing_lengths = self.calculate_smoothing_lengths(
             self.positions,
@@ -59,19 +108,13 @@ class GadgetData(object):
 
         if not silent: print("Calculating pressures")
         if adiabats is not None:
-            self.pressures = self.calculate_pressures_adiabats(
+            # We also need to update internal energies to match.
+            self.pressures, self.energies = self.calculate_pressures_energies(
                 self.densities,
                 self.adiabats,
                 gamma=self.gamma,
             )
 
-            # We now need to update internal energies to match.
-            self.energies = self.calculate_energies(
-                self.adiabats,
-                self.densities,
-                gamma=self.gamma
-            )
-            
         else: # We must be using internal energies
             self.pressures = self.calculate_pressures(
                 self.densities,
@@ -88,37 +131,53 @@ class GadgetData(object):
         """
         Calculates the density at all of the particle positions.
         
-        + h, the smoothing length at that position
-        + positions, the positions of the other particles.
+        + positions, the positions of the particles,
+        + smoothing_lengths, the smoothing length of each particle,
+        + kernel, a callable with arguments (r, h) that accepts arrays.
         """
 
-        sep_between_all = [sph.separations(r, positions) for r in positions]
-        def density_with_kernel(sep, smooth): return gadget.density(sep, smooth, kernel=kernel)
+        positions = np.asarray(positions)
+        smoothing_lengths = np.asarray(smoothing_lengths, dtype=positions.dtype)
 
-        return list(
-            map(
-                density_with_kernel,
-                sep_between_all,
-                smoothing_lengths,
+        if self.backend == "cupy":
+            return sph.cupy.asnumpy(
+                gadget.density_all(
+                    sph.cupy.asarray(positions),
+                    sph.cupy.asarray(smoothing_lengths),
+                    kernel=kernel
+                )
             )
-        )
+
+        return gadget.density_all(positions, smoothing_lengths, kernel=kernel)
 
 
     def calculate_smoothing_lengths(self, positions, initial=1., eta=0.2, tol=None, kernel=None):
         """
         Calculates all of the smoothing lengths for all of the particles given
-        in positions.
+        in positions, with the batched Newton solver gadget.solve_h_batch.
 
         Assumes they all have mass 1.
         """
 
-        def calc_this_h(sep): return gadget.h(sep, eta=eta, tol=tol, kernel=kernel)
+        positions = np.asarray(positions)
 
-        return list(
-            map(
-                calc_this_h,
-                [sph.separations(r, positions) for r in positions]
+        if self.backend == "cupy":
+            return sph.cupy.asnumpy(
+                gadget.solve_h_batch(
+                    sph.cupy.asarray(positions),
+                    initial=initial,
+                    eta=eta,
+                    tol=tol,
+                    kernel=kernel
+                )
             )
+
+        return gadget.solve_h_batch(
+            positions,
+            initial=initial,
+            eta=eta,
+            tol=tol,
+            kernel=kernel
         )
 
 
@@ -127,9 +186,11 @@ class GadgetData(object):
         Calculates the pressures for all of the particles given their
         densities and energies.
         """
-        def p_at_gamma(rho, e): return gadget.gas_pressure(rho, e, gamma)
-
-        return list(map(p_at_gamma, densities, energies))
+        return gadget.gas_pressure(
+            np.asarray(densities),
+            np.asarray(energies),
+            gamma
+        )
 
 
     def calculate_pressures_adiabats(self, densities, adiabats, gamma=4./3.):
@@ -137,9 +198,24 @@ class GadgetData(object):
         Calculates the pressures for all of the particles given their
         densities and adiabats.
         """
-        def p_at_gamma(rho, A): return gadget.gas_pressure_adiabat(rho, A, gamma)
-    
-        return list(map(p_at_gamma, densities, adiabats))
+        return gadget.gas_pressure_adiabat(
+            np.asarray(densities),
+            np.asarray(adiabats),
+            gamma
+        )
+
+
+    def calculate_pressures_energies(self, densities, adiabats, gamma=4./3.):
+        """
+        Calculates both the pressures and the internal energies of the
+        particles given their densities and adiabats, in a single pass over
+        the densities. Returns (pressures, energies).
+        """
+        return gadget.gas_pressure_and_energy_adiabat(
+            np.asarray(densities),
+            np.asarray(adiabats),
+            gamma
+        )
 
 
     def calculate_energies(self, adiabats, densities, gamma=4./3.):
@@ -150,14 +226,10 @@ class GadgetData(object):
                 u = A rho^(gamma - 1)/(gamma - 1)
 
         """
-        def u_at_gamma(a, rho): return gadget.internal_energy(a, rho, gamma)
-
-        return list(
-            map(
-                u_at_gamma,
-                adiabats,
-                densities
-            )
+        return gadget.internal_energy(
+            np.asarray(adiabats),
+            np.asarray(densities),
+            gamma
         )
 
 
@@ -173,7 +245,8 @@ class PressureEntropyData(object):
             eta=5,
             silent=False,
             gamma=4./3.,
-            kernel=sph.gadget_kernel
+            kernel=sph.gadget_kernel,
+            dtype=np.float64
         ):
         """
         + positions are the positions of the particles,
@@ -185,6 +258,9 @@ class PressureEntropyData(object):
         + silent is a boolean, if True it enables printing of information,
         + gamma is the ratio of specific heats of the gas,
         + kernel is the SPH kernel to use. The default is GADGET's.
+        + dtype is the precision of the positions, smoothing lengths and
+          densities (see GadgetData). The kernel weights, adiabats and
+          pressures are always kept in float64.
 
         This class makes available the following properties:
         + positions,
@@ -210,19 +286,21 @@ class PressureEntropyData(object):
             )
 
         self.silent = silent
-        self.positions = positions
+        # As in GadgetData, each particle property is its own contiguous array.
+        self.positions = np.ascontiguousarray(positions, dtype=dtype)
         self.gamma = gamma
         self.kernel = kernel
 
         if not silent: print("Grabbing the GadgetData object")
         self.gadget = GadgetData(
-            positions,
+            self.positions,
             energies,
             adiabats,
             eta,
             silent,
             gamma,
-            kernel
+            kernel,
+            dtype=dtype
         )
 
         self.densities = self.gadget.densities
@@ -230,6 +308,23 @@ class PressureEntropyData(object):
         self.energies = self.gadget.energies
         self.adiabats = self.gadget.adiabats
 
+        # The smoothing lengths are now fixed, so the kernel weights between
+        # every pair of particles are shared by all of the passes below.
+        # These are always float64: the minimisation's tolerance on the
+        # change in A is finer than float32 sums over the neighbours resolve.
+        # For compact kernels this is a sparse matrix over the neighbours.
+        positions = self.gadget.positions.astype(np.float64)
+        smoothing_lengths = self.gadget.smoothing_lengths.astype(np.float64)
+
+        self._weights = sph.kernel_matrix(
+            positions,
+            smoothing_lengths,
+            self.kernel,
+            neighbours=gadget.neighbour_list(
+                positions, smoothing_lengths, self.kernel
+            )
+        )
+
         if not silent: print("Starting Pressure-Entropy calculation")
         if adiabats is None:
             # Sort out your adiabats/energies.
@@ -246,7 +341,8 @@ class PressureEntropyData(object):
             self.gadget.smoothing_lengths,
             self.gadget.energies,
             gamma=self.gamma,
-            kernel=self.kernel
+            kernel=self.kernel,
+            weights=self._weights
         )
 
         if not silent: print("Calculating smoothed pressures")
@@ -255,7 +351,8 @@ class PressureEntropyData(object):
             self.adiabats,
             self.gadget.smoothing_lengths,
             gamma=self.gamma,
-            kernel=self.kernel
+            kernel=self.kernel,
+            weights=self._weights
         )
 
         if not silent: print("Calculating smoothed densities")
@@ -276,33 +373,45 @@ class PressureEntropyData(object):
         + energies are the internal energies
         + densities are the densities of the particles.
         """
-        def A_at_gamma(e, rho): return pressure_entropy.A(e, rho, gamma)
-
-        return list(map(A_at_gamma, energies, densities))
+        return pressure_entropy.A(
+            np.asarray(energies),
+            np.asarray(densities),
+            gamma
+        )
 
 
-    def pressures(self, r, A, h, kernel, gamma=4./3.):
+    def pressures(self, r, A, h, kernel, gamma=4./3., weights=None):
         """
         Calculates the smoothed pressures according to Pressure-Entropy,
         at the positions of each of the particles.
 
         + r are the particle positions,
         + A are the particle Adiabats,
-        + h are the smoothing lengths of the particles from GADGETSPH.
+        + h are the smoothing lengths of the particles from GADGETSPH,
+        + weights is the (dense or sparse) matrix of kernel weights from
+          sph.kernel_matrix. If not given, it is calculated from r and h, or
+          for the GADGET kernel with numba available the pressures are
+          summed in a parallel loop (on the GPU, for many particles) without
+          building the matrix.
         """
 
-        sep_between_all = [sph.separations(this_r, r) for this_r in r]
-        
-        def p_given_A(separations, this_h):
-            return pressure_entropy.pressure(separations, A, this_h, kernel, gamma)
-
-        return list(
-            map(
-                p_given_A,
-                sep_between_all,
-                h
-            )
-        )
+        if weights is None:
+            if kernel is sph.gadget_kernel and gadget.use_gpu(len(r)):
+                return sph_cuda.pressure_all(r, h, A, gamma)
+            elif kernel is sph.gadget_kernel and sph_numba.NUMBA_AVAILABLE:
+                r = np.asarray(r, dtype=np.float64)
+
+                return sph_numba.pressure_all(
+                    r,
+                    np.asarray(h, dtype=np.float64),
+                    np.asarray(A, dtype=np.float64),
+                    gamma,
+                    np.empty_like(r)
+                )
+
+            weights = sph.kernel_matrix(np.asarray(r), np.asarray(h), kernel)
+
+        return pressure_entropy.pressure_all(weights, A, gamma)
 
 
     def density_twiddle(self, A, P, gamma=4./3.):
@@ -313,15 +422,14 @@ class PressureEntropyData(object):
         + P are the pressures,
         + gamma of the gas.
         """
-        def smoothed_at_gamma(a, p): return pressure_entropy.smoothed_density(a, p, gamma)
-        return list(
-            map(
-                smoothed_at_gamma, A, P
-            )
+        return pressure_entropy.smoothed_density(
+            np.asarray(A),
+            np.asarray(P),
+            gamma
         )
 
 
-    def minimise_A(self, A, r, h, energies, kernel, tol=1e-7, gamma=4./3.):
+    def minimise_A(self, A, r, h, energies, kernel, tol=1e-7, gamma=4./3., method="jacobi", weights=None):
         """
         Finds the equlibrium value of A using the Pressure-Entropy SPH
         technique.
@@ -330,29 +438,94 @@ class PressureEntropyData(object):
         + r are the positions of each particle
         + h are the smoothing lenghts of each particle
         + energies are the internal energies of each particles
-        + tol is the tolerance between iterations.
+        + tol is the tolerance between iterations
+        + method is either "jacobi", which updates every particle at once
+          from the previous iteration's values, or "gauss-seidel", which
+          updates the particles one at a time in place. Both converge to
+          the same equilibrium
+        + weights is the (dense or sparse) matrix of kernel weights from
+          sph.kernel_matrix, used by the Jacobi method. If not given, it is
+          calculated.
         """
 
+        if method == "jacobi":
+            return self._minimise_A_jacobi(
+                A, r, h, energies, kernel, tol, gamma, weights
+            )
+        elif method != "gauss-seidel":
+            raise AttributeError(
+                "Unknown method {}, please use jacobi or gauss-seidel.".format(method)
+            )
+
         difference = tol + 1
-        old = A.copy()
-        new = old.copy()
+        A = np.array(A, dtype=np.float64)
+        previous = np.empty_like(A)
+        h = np.asarray(h, dtype=np.float64)
+        energies = np.asarray(energies, dtype=np.float64)
+
+        # A^(1/gamma) is kept alongside A, and A_reduced only updates the
+        # entry of the particle that it has just solved for.
+        A_pow = np.power(A, 1. / gamma)
+
+        # The positions don't change while we iterate, so neither do the
+        # separations between the particles.
+        r = np.asarray(r, dtype=np.float64)
+        separations = r[:, None] - r[None, :]
+        np.abs(separations, out=separations)
 
         # As each particle's A depends on each other, we must iterate until
         # convergence in this lazy way.
         while difference > tol:
-            # We iterate over each particle and update its A to be the
-            # Equilibrium given the values of its neighbors
-            for index, (this_A, this_h, this_u) in enumerate(zip(old, h, energies)):
-                separations = sph.separations(r[index], r)
+            # Keep this sweep's starting values, in a buffer that is reused
+            # between sweeps, to measure the change against.
+            np.copyto(previous, A)
 
-                this_A, new = pressure_entropy.A_reduced(
-                    separations, new, this_h, this_u, this_A, index, kernel, gamma
+            # We iterate over each particle and update its A to be the
+            # Equilibrium given the values of its neighbors. A_reduced
+            # updates A in place, and separations[index] is a view.
+            for index in range(len(A)):
+                pressure_entropy.A_reduced(
+                    separations[index],
+                    A,
+                    h[index],
+                    energies[index],
+                    A[index],
+                    index,
+                    kernel,
+                    gamma,
+                    A_pow=A_pow
                 )
-                
+
+            # The change is only measured once per sweep over the particles.
+            difference = sph.diff(previous, A)
+
+            if not self.silent: print("Difference: {}".format(difference))
+
+        return A
+
+
+    def _minimise_A_jacobi(self, A, r, h, energies, kernel, tol=1e-7, gamma=4./3., weights=None):
+        """
+        The Jacobi version of minimise_A. The kernel weights do not change
+        between iterations, so they are computed (at most) once up-front.
+        """
+
+        if weights is None:
+            weights = sph.kernel_matrix(np.asarray(r), np.asarray(h), kernel)
+        energies = np.asarray(energies, dtype=np.float64)
+
+        difference = tol + 1
+
+        # Ping-pong between two buffers rather than allocating each iteration.
+        old = np.array(A, dtype=np.float64)
+        new = np.empty_like(old)
+
+        while difference > tol:
+            pressure_entropy.A_reduced_all(weights, old, energies, gamma, out=new)
+
             difference = sph.diff(old, new)
-            old = new.copy()
+            old, new = new, old
 
             if not self.silent: print("Difference: {}".format(difference))
 
         return old
-
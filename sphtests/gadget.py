@@ -1,29 +1,234 @@
-from scipy.optimize import root
-from sphtests.sph import gadget_kernel
+import numpy as np
+
+from scipy.optimize import brentq
+from sphtests import sph, sph_cuda, sph_cython, sph_numba
+from sphtests.sph import gadget_kernel, gadget_kernel_poly
+
+# The pairwise passes work on blocks of rows of the N x N separation matrix
+# that are no larger than this (in bytes), so each block stays in L2 cache.
+BLOCK_BYTES = 2**20
+
+# Neighbour lists are only used when the largest kernel covers less than this
+# fraction of the extent of the particles; otherwise we loop over all pairs.
+NEIGHBOUR_FRACTION = 0.25
+
+# Above this many particles, the passes over all pairs with the GADGET kernel
+# are run on a CUDA GPU if one is available (see sph_cuda); below it the
+# transfers cost more than they save.
+GPU_THRESHOLD = 10**5
+
+
+def block_size(n, itemsize=8):
+    """
+    The number of rows of an n-column float array that fit in BLOCK_BYTES.
+    """
+    return max(1, BLOCK_BYTES // (n * itemsize))
+
+
+def neighbour_list(positions, h, kernel=gadget_kernel):
+    """
+    The CSR neighbour list (indptr, indices) of the particles, from
+    sph.build_neighbour_list, out to the support of the kernel. Returns None
+    if the kernel does not have compact support, or if it is so wide compared
+    to the extent of the particles that looping over all pairs is cheaper.
+    GPU (cupy) arrays, and no particles at all, always loop over all pairs.
+    """
+    support = sph.KERNEL_SUPPORT.get(kernel)
+
+    if support is None or not isinstance(positions, np.ndarray) or len(positions) == 0:
+        return None
+
+    radii = support * h
+    extent = positions.max() - positions.min()
+
+    if 2 * radii.max() > NEIGHBOUR_FRACTION * extent:
+        return None
+
+    return sph.build_neighbour_list(positions, radii)
+
 
 def density(r, h, masses=None, kernel=gadget_kernel):
     """
     Calculates the SPH density from a set of particle separations.
 
-    + r are the particle separations.
+    + r are the particle separations, a list or array.
     + h is the smoothing lengths.
     + masses are the particle masses. If not given, we assume the
       particles are all equally massive with M=1.
-    + kernel, a callable with arguments (r, h). Defaults to GADGET.
+    + kernel, a callable with arguments (r, h) that accepts an array of
+      separations. Defaults to GADGET, which uses a compiled loop if numba
+      (or, failing that, Cython and the vectorised C sum in _kernel.c) is
+      available.
     """
-    
-    def kernel_at_h(radius): return kernel(abs(radius), h)
 
-    weights = map(kernel_at_h, r)
+    r = np.abs(np.asarray(r, dtype=np.float64))
+
+    if kernel is gadget_kernel and masses is None and sph_numba.NUMBA_AVAILABLE:
+        return sph_numba.density_row(r, h)
+    elif kernel is gadget_kernel and masses is None and sph_cython.CYTHON_AVAILABLE:
+        return sph_cython.density_row(r, h)
+
+    support = sph.KERNEL_SUPPORT.get(kernel)
+
+    if support is not None:
+        # Only evaluate the kernel for the neighbours that it is non-zero for.
+        inside = r <= support * h
+        r = r[inside]
+
+        if masses is not None:
+            masses = np.asarray(masses)[inside]
+
+    weights = kernel(r, h)
 
     if masses is not None:
-        density = sum([m*w for m, w in zip(masses, weights)])
+        density = np.dot(weights, masses)
     else:
-        density = sum(weights)
+        density = np.sum(weights)
 
     return density
 
 
+def density_all(positions, h, masses=None, kernel=gadget_kernel):
+    """
+    Calculates the SPH density at every particle position at once.
+
+    + positions are the particle positions (float32 or float64 array),
+    + h are the smoothing lengths of each of the particles,
+    + masses are the particle masses (array). If not given, we assume the
+      particles are all equally massive with M=1,
+    + kernel, a callable with arguments (r, h) that accepts arrays.
+      Defaults to GADGET, which uses the compiled loops if numba (or, failing
+      that, Cython) is available.
+
+    The densities are returned with the same dtype, and as the same type of
+    array, as the positions; cupy arrays are evaluated on the GPU.
+    """
+    n = len(positions)
+    densities = np.empty_like(positions)
+    symmetric = n > 0 and np.all(h == h[0])
+    neighbours = neighbour_list(positions, h, kernel)
+    compiled = (
+        kernel is gadget_kernel
+        and masses is None
+        and isinstance(positions, np.ndarray)
+    )
+
+    if compiled and neighbours is None and use_gpu(n):
+        densities[:] = density_gpu(positions, h)
+        return densities
+    elif compiled and sph_numba.NUMBA_AVAILABLE:
+        if neighbours is not None:
+            return sph_numba.density_neighbours(positions, h, *neighbours, densities)
+        else:
+            return sph_numba.density_all(positions, h, densities)
+    elif compiled and sph_cython.CYTHON_AVAILABLE and neighbours is None:
+        densities[:] = sph_cython.density_all(positions, h)
+        return densities
+
+    if kernel is gadget_kernel:
+        # The normalisation 4/(3 h_i) is the same along each row, so we sum
+        # just the polynomial and apply it once per particle at the end. The
+        # weight is given 1/h in place of h, so the rows only multiply.
+        weight = _gadget_kernel_unnormalised
+        h = 1 / h
+        prefactor = (4 / 3) * h
+    else:
+        weight = kernel
+        prefactor = 1.
+
+    step = block_size(n, positions.itemsize)
+
+    if neighbours is not None:
+        _density_neighbours(positions, h, masses, weight, densities, *neighbours)
+    elif symmetric:
+        _density_all_symmetric(positions, h[0], masses, weight, densities, step)
+    else:
+        # Row i holds the separations of every particle from particle i; we
+        # only ever build a block of these rows at a time.
+        for start in range(0, n, step):
+            stop = start + step
+            separations = positions[start:stop, None] - positions[None, :]
+            np.abs(separations, out=separations)
+            weights = weight(separations, h[start:stop, None])
+
+            if masses is not None:
+                densities[start:stop] = weights @ masses
+            else:
+                densities[start:stop] = weights.sum(axis=1)
+
+    densities *= prefactor
+
+    return densities
+
+
+def use_gpu(n):
+    """
+    Whether a pass over all pairs of n particles should be run on the GPU.
+    """
+    return sph_cuda.CUDA_AVAILABLE and n > GPU_THRESHOLD
+
+
+def density_gpu(positions, h):
+    """
+    Calculates the SPH density at every particle position with the GADGET
+    kernel on a CUDA GPU (see sph_cuda.density_all). The densities are
+    returned as a float64 numpy array.
+
+    + positions are the particle positions (numpy or cupy array),
+    + h are the smoothing lengths of each of the particles.
+    """
+    return sph_cuda.density_all(positions, h)
+
+
+def _gadget_kernel_unnormalised(r, inv_h):
+    return gadget_kernel_poly(r * inv_h)
+
+
+def _density_neighbours(positions, h, masses, kernel, densities, indptr, indices):
+    """
+    The density pass over a CSR neighbour list, evaluating the kernel for
+    every (particle, neighbour) pair at once and summing them per particle.
+    """
+    rows = np.repeat(np.arange(len(positions)), np.diff(indptr))
+    separations = np.abs(positions[rows] - positions[indices])
+    weights = kernel(separations, h[rows])
+
+    if masses is not None:
+        weights = weights * masses[indices]
+
+    densities[:] = np.bincount(rows, weights=weights, minlength=len(positions))
+
+
+def _density_all_symmetric(positions, h, masses, kernel, densities, step):
+    """
+    The blocked density pass for when all of the particles share the same
+    smoothing length h, so that W_ij = W_ji. Each block only evaluates the
+    kernel for the pairs with j > i, and adds each weight to both particles.
+    The densities are accumulated in to the densities array.
+    """
+    densities[:] = kernel(np.zeros_like(positions, shape=1), h)[0]
+
+    if masses is not None:
+        densities *= masses
+
+    for start in range(0, len(positions), step):
+        stop = start + step
+        separations = positions[start:stop, None] - positions[None, start:]
+        np.abs(separations, out=separations)
+        weights = kernel(separations, h)
+
+        # Drop the j <= i pairs that lie within this block of rows.
+        diagonal = weights[:, :step]
+        diagonal[...] = np.triu(diagonal, k=1)
+
+        if masses is not None:
+            densities[start:stop] += weights @ masses[start:]
+            densities[start:] += masses[start:stop] @ weights
+        else:
+            densities[start:stop] += weights.sum(axis=1)
+            densities[start:] += weights.sum(axis=0)
+
+
 def h(r, initial=1., mass=1, eta=0.84, tol=None, masses=None, kernel=gadget_kernel):
     """
     Calculates the smoothing length for a particle.
@@ -35,24 +240,207 @@ def h(r, initial=1., mass=1, eta=0.84, tol=None, masses=None, kernel=gadget_kern
     + tol is the tolerance to find h to
     + masses are the masses of the other particles
     """
+    r = np.abs(np.asarray(r))
+
     def to_reduce(this_h):
-        dens = density(r, abs(this_h), masses, kernel=kernel)
-        
-        return this_h - eta * mass / dens
+        # h rho(h) is monotonic in h, so this has a single root.
+        return this_h * density(r, this_h, masses, kernel=kernel) - eta * mass
+
+    # Find a bracket around the root by halving/doubling the initial guess.
+    # If there is no root (e.g. eta is too small for the kernel), brentq
+    # raises a ValueError on the final bracket.
+    low, high = 0.5 * initial, 2. * initial
+
+    for _ in range(100):
+        if to_reduce(low) > 0:
+            low, high = 0.5 * low, low
+        elif to_reduce(high) < 0:
+            low, high = high, 2. * high
+        else:
+            break
 
     if tol is not None:
-        fitted = root(
-            to_reduce,
-            initial,
-            tol=tol,
-        )
+        return brentq(to_reduce, low, high, xtol=tol)
     else:
-        fitted = root(
-            to_reduce,
-            initial,
+        return brentq(to_reduce, low, high)
+
+
+def h_all(positions, initial=1., eta=0.84, tol=None, max_iter=100, kernel=gadget_kernel):
+    """
+    Calculates the smoothing lengths for all of the particles at once, by
+    iterating the neighbour-number corrector
+
+            h_new = h * 0.5 * (1 + eta / (h rho))
+
+    on every particle simultaneously until the solution is bracketed by the
+    last values of h either side of it, after which we bisect the bracket.
+
+    + positions are the particle positions (float32 or float64 array),
+    + initial is the initial guess for the smoothing lengths,
+    + eta is the smoothing length in terms of the mean interparticle separation,
+    + tol is the tolerance on |h rho / eta - 1|. Defaults to 1e-10, or to
+      what the precision of the positions allows if that is coarser,
+    + max_iter is the maximum number of iterations,
+    + kernel, a callable with arguments (r, h) that accepts arrays.
+
+    The smoothing lengths have the same dtype, and are the same type of array
+    (numpy or cupy), as the positions. Assumes that all of the particles have
+    mass 1.
+    """
+    if tol is None:
+        tol = max(1e-10, 100 * np.finfo(positions.dtype).eps)
+
+    h = np.full_like(positions, initial)
+    low = np.zeros_like(h)
+    high = np.full_like(h, np.inf)
+
+    for _ in range(max_iter):
+        neighbours = h * density_all(positions, h, kernel=kernel)
+        residual = neighbours / eta - 1
+
+        if np.max(np.abs(residual)) < tol:
+            break
+
+        too_small = residual < 0
+        low = np.where(too_small, h, low)
+        high = np.where(too_small, high, h)
+
+        corrected = h * 0.5 * (1 + eta / neighbours)
+        h = np.where(np.isinf(high), corrected, 0.5 * (low + high))
+
+    return h
+
+
+def solve_h_batch(positions, initial=1., eta=0.84, tol=None, max_iter=100, kernel=gadget_kernel):
+    """
+    Calculates the smoothing lengths for all of the particles at once with a
+    safeguarded Newton-Raphson iteration on
+
+            f(h) = h rho(h) - eta,
+
+    using d(h rho)/dh from the kernel's entry in sph.KERNEL_H_DERIVATIVE.
+    Steps that would leave the current bracket around the root are replaced
+    by the neighbour-number corrector, or by bisection, as in h_all. Kernels
+    without a known derivative fall back to h_all.
+
+    The arguments and the returned smoothing lengths are as for h_all.
+    """
+    derivative = sph.KERNEL_H_DERIVATIVE.get(kernel)
+
+    if derivative is None:
+        return h_all(positions, initial, eta, tol, max_iter, kernel)
+
+    if tol is None:
+        tol = max(1e-10, 100 * np.finfo(positions.dtype).eps)
+
+    compiled = (
+        kernel is gadget_kernel
+        and sph_numba.NUMBA_AVAILABLE
+        and isinstance(positions, np.ndarray)
+    )
+
+    h = np.full_like(positions, initial)
+    low = np.zeros_like(h)
+    high = np.full_like(h, np.inf)
+
+    for _ in range(max_iter):
+        if compiled:
+            density, slope = _density_h_derivative_compiled(positions, h)
+        else:
+            density = density_all(positions, h, kernel=kernel)
+
+        neighbours = h * density
+        residual = neighbours / eta - 1
+        converged = np.abs(residual) < tol
+
+        if np.all(converged):
+            break
+
+        too_small = residual < 0
+        low = np.where(too_small, h, low)
+        high = np.where(too_small, high, h)
+
+        if not compiled:
+            slope = density_all(positions, h, kernel=derivative)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            newton = h - (neighbours - eta) / slope
+
+        fallback = np.where(
+            np.isinf(high),
+            h * 0.5 * (1 + eta / neighbours),
+            0.5 * (low + high)
+        )
+        step = np.where((newton > low) & (newton < high), newton, fallback)
+
+        # Particles that have already converged are left where they are, so
+        # that they can't be knocked back out by a step across their bracket.
+        h = np.where(converged, h, step)
+
+    return h
+
+
+def _density_h_derivative_compiled(positions, h):
+    """
+    The densities and d(h rho)/dh of every particle with the GADGET kernel,
+    computed together in one of the numba (or, for many particles, CUDA)
+    passes.
+    """
+    density = np.empty_like(h)
+    slope = np.empty_like(h)
+    neighbours = neighbour_list(positions, h)
+
+    if neighbours is not None:
+        return sph_numba.density_h_derivative_neighbours(
+            positions, h, *neighbours, density, slope
         )
+    elif use_gpu(len(positions)):
+        density[:], slope[:] = sph_cuda.density_h_derivative_all(positions, h)
+        return density, slope
+    else:
+        return sph_numba.density_h_derivative_all(positions, h, density, slope)
+
+
+def compute_all(positions, energies, initial=1., eta=0.84, gamma=4./3., tol=None, max_iter=100):
+    """
+    Calculates the smoothing lengths, densities and gas pressures of all of
+    the particles together with the GADGET kernel, in one fused numba pass
+    (see sph_numba.compute_all), so that the positions are only streamed
+    through once. Each particle only visits the neighbours inside its
+    kernel, found by scanning the sorted positions.
+
+    + positions are the particle positions (float32 or float64 array),
+    + energies are the internal energies of the particles,
+    + initial, eta, tol and max_iter are as for h_all,
+    + gamma of the gas.
 
-    return fitted.x[0]
+    Returns (smoothing_lengths, densities, pressures). The first two have
+    the dtype of the positions, and the pressures are float64. Requires
+    numba.
+    """
+    if tol is None:
+        tol = max(1e-10, 100 * np.finfo(positions.dtype).eps)
+
+    order = np.argsort(positions, kind="stable")
+
+    h, densities, pressures = sph_numba.compute_all(
+        positions[order],
+        np.asarray(energies, dtype=np.float64)[order],
+        eta,
+        gamma,
+        initial,
+        tol,
+        max_iter,
+        np.empty_like(positions),
+        np.empty_like(positions),
+        np.empty(len(positions), dtype=np.float64)
+    )
+
+    # Put the results back in the order of the original positions.
+    inverse = np.empty_like(order)
+    inverse[order] = np.arange(len(order))
+
+    return h[inverse], densities[inverse], pressures[inverse]
 
 
 def gas_pressure(density, internal_energy, gamma=4./3.):
@@ -62,6 +450,8 @@ def gas_pressure(density, internal_energy, gamma=4./3.):
             P = (gamma - 1) * rho * u
 
     + gamma has an initial value of 4/3
+
+    density and internal_energy may be floats or arrays.
     """
 
     g_minus_1 = gamma - 1
@@ -75,6 +465,8 @@ def gas_pressure_adiabat(density, adiabat, gamma=4./3.):
             P = A rho^gamma.
 
     + gamma has an initial value of 4/3.
+
+    density and adiabat may be floats or arrays.
     """
 
     return adiabat * density**gamma
@@ -88,8 +480,27 @@ def internal_energy(adiabat, density, gamma=4./3.):
         
             u = A rho^(gamma - 1)/(gamma - 1)
 
+    adiabat and density may be floats or arrays.
     """
     g_minus_1 = gamma - 1.
     return (adiabat/g_minus_1) * density**(g_minus_1)
 
 
+def gas_pressure_and_energy_adiabat(density, adiabat, gamma=4./3.):
+    """
+    Both the gas pressure and internal energy given the adiabats, i.e.
+
+            P = A rho^gamma,
+            u = A rho^(gamma - 1)/(gamma - 1),
+
+    computed together so that A rho^(gamma - 1), which they share, is only
+    evaluated once.
+
+    density and adiabat may be floats or arrays. Returns (P, u).
+    """
+    g_minus_1 = gamma - 1.
+    A_rho_g_minus_1 = adiabat * density**g_minus_1
+
+    return A_rho_g_minus_1 * density, A_rho_g_minus_1 / g_minus_1
+
+
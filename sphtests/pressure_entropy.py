@@ -1,5 +1,7 @@
-from sphtests.sph import gadget_kernel
-from scipy.optimize import root
+import numpy as np
+
+from sphtests import sph_numba
+from sphtests.sph import gadget_kernel, KERNEL_SUPPORT
 
 
 def A(energy, density, gamma=4./3.):
@@ -8,6 +10,8 @@ def A(energy, density, gamma=4./3.):
 
     + energy is the internal energy of the particle
     + density is the density of the particle
+
+    energy and density may be floats or arrays.
     """
     g_minus_1 = gamma - 1.
     return energy * g_minus_1 / (density**g_minus_1) 
@@ -18,30 +22,66 @@ def pressure(r, A, h, kernel, gamma=4./3., masses=None):
     Calculates the pressure-entropy smoothed pressure (note this is _not_ the
     gas pressure) based on the:
 
-    + r, the interparticle separations,
-    + A, the adiabats of the particles,
+    + r, the interparticle separations, a list or array,
+    + A, the adiabats of the particles, a list or array,
     + h, the smoothing length of the particle being considered,
     + gamma of the gas,
     + masses, the masses of the other particles. If none, assumed to all be 1,
-    + kernel, a callable with arguents (r, h). Defaults to GADGET.
+    + kernel, a callable with arguents (r, h) that accepts an array of
+      separations. Defaults to GADGET, which uses a compiled loop if numba
+      is available.
     """
     
-    one_over_gamma = 1./gamma
+    r = np.asarray(r, dtype=np.float64)
+    A = np.asarray(A, dtype=np.float64)
+
+    if kernel is gadget_kernel and masses is None and sph_numba.NUMBA_AVAILABLE:
+        return sph_numba.pressure_row(r, A, h, gamma)
+
+    support = KERNEL_SUPPORT.get(kernel)
 
-    def kernel_at_h(radius): return kernel(radius, h)
-    def A_one_over_gamma(A): return A**(one_over_gamma)
+    if support is not None:
+        # Skip the kernel and, more importantly, the A^(1/gamma) for all of
+        # the particles that are outside of the kernel.
+        inside = r <= support * h
+        r = r[inside]
+        A = A[inside]
 
-    weights = map(kernel_at_h, r)
-    As = map(A_one_over_gamma, A)
+        if masses is not None:
+            masses = np.asarray(masses)[inside]
+
+    one_over_gamma = 1./gamma
+
+    weights = kernel(r, h) * A**one_over_gamma
 
     if masses is not None:
-        P = sum([m*w*a for m, w, a in zip(masses, weights, As)])
+        P = np.dot(weights, masses)
     else:
-        P = sum([w*a for w, a in zip(weights, As)])
+        P = np.sum(weights)
 
     return P**gamma
 
 
+def pressure_all(weights, A, gamma=4./3.):
+    """
+    Calculates the pressure-entropy smoothed pressure of every particle at
+    once, given
+
+    + weights, the N x N (dense or scipy.sparse) matrix of kernel weights
+      W_ij = W(r_ij, h_i),
+    + A, the adiabats of the particles,
+    + gamma of the gas.
+
+    All of the particles are assumed to have M=1. The sum is carried out in
+    the precision of the weights (e.g. float32), and the pressures are
+    returned in float64.
+    """
+    precision = weights.dtype.type
+    A_pow = np.asarray(A, dtype=precision)**precision(1. / gamma)
+
+    return np.asarray(weights @ A_pow, dtype=np.float64)**gamma
+
+
 def smoothed_density(A, P, gamma=4./3.):
     """
     The smoothed density of the particle, according to Pressure-Entropy
@@ -50,11 +90,13 @@ def smoothed_density(A, P, gamma=4./3.):
     + A is the adiabat of the particle
     + P is the pressure of the particle
     + gamma of the gas.
+
+    A and P may be floats or arrays.
     """
     return (P/A)**(1/gamma)
 
 
-def A_reduced(r, A, h, energy, initial, index, kernel, gamma=4./3., tol=None, masses=None):
+def A_reduced(r, A, h, energy, initial, index, kernel, gamma=4./3., tol=None, masses=None, max_iter=50, A_pow=None):
     """
     Calculates the optimum value of A for the particle, with
 
@@ -66,35 +108,114 @@ def A_reduced(r, A, h, energy, initial, index, kernel, gamma=4./3., tol=None, ma
     + index, the index in A that corresponds to _this_ particle.
       If the particle is not in the array, set index to be -1.
     + gamma of the gas,
-    + tol the tolerance to find A to,
+    + tol the tolerance on the Newton step in log(A). Defaults to 1e-12,
     + masses are the masses of all of the particles. Assumed to be 1.
+    + max_iter the maximum number of Newton steps.
+    + A_pow, optionally A^(1/gamma) for all of the particles. Callers that
+      solve for the particles one at a time can keep this up to date (it is
+      updated in place along with A) rather than have it recomputed for
+      every particle.
+
+    Only the particle's own term in the pressure sum depends on its A, so the
+    sum over the others, S, is computed once and the scalar equation
+
+            gamma log(S + W_ii a^(1/gamma)) + log(a)/(gamma - 1) = C
+
+    (see A_reduced_all) is solved with Newton's method in log(a). If index is
+    not -1, A[index] is updated in place.
     """
+    one_over_gamma = 1. / gamma
     gamma_minus_1 = gamma - 1
 
-    def to_reduce(this_A):
-        # Has some lovely side effects, sorry about that...
-        if index != -1:
-            A[index] = this_A
+    if tol is None:
+        tol = 1e-12
+
+    weights = kernel(np.asarray(r, dtype=np.float64), h)
+
+    if masses is not None:
+        weights = weights * np.asarray(masses)
 
-        P_sum = pressure(r, A, h, kernel, gamma, masses)
-        P_calc = this_A * ((energy/this_A) * gamma_minus_1)**(gamma/gamma_minus_1)
+    if A_pow is None:
+        A_pow = np.asarray(A, dtype=np.float64)**one_over_gamma
 
-        return 1 - P_sum/P_calc
+    others = np.dot(weights, A_pow)
 
-    if tol is not None:
-        fitted = root(
-            to_reduce,
-            initial,
-            tol=tol,
-        )
+    if index != -1:
+        self_weight = weights[index]
+        others -= self_weight * A_pow[index]
     else:
-        fitted = root(
-            to_reduce,
-            initial,
-        )
+        self_weight = 0.
+
+    target = (gamma / gamma_minus_1) * np.log(energy * gamma_minus_1)
+    log_A = np.log(initial)
+
+    for _ in range(max_iter):
+        self_term = self_weight * np.exp(log_A * one_over_gamma)
+        total = others + self_term
+
+        residual = gamma * np.log(total) + log_A / gamma_minus_1 - target
+        gradient = self_term / total + 1. / gamma_minus_1
+
+        step = residual / gradient
+        log_A -= step
+
+        if abs(step) < tol:
+            break
+
+    this_A = float(np.exp(log_A))
 
     if index != -1:
-        A[index] = fitted.x[0]
+        A[index] = this_A
+        A_pow[index] = this_A**one_over_gamma
+
+    return this_A, A
+
+
+def A_reduced_all(weights, A, energies, gamma=4./3., tol=1e-12, max_iter=50, out=None):
+    """
+    Calculates the optimum value of A for every particle at once, holding
+    the adiabats of all of the _other_ particles fixed at A (i.e. one Jacobi
+    step of the iteration in A_reduced). Each particle then has the scalar
+    equation
+
+            gamma log(S_i + W_ii a^(1/gamma)) + log(a)/(gamma - 1) = C_i,
+
+    with S_i the pressure sum over the other particles, which is monotonic in
+    log(a) and is solved with Newton's method for all particles together.
+
+    + weights, the N x N (dense or scipy.sparse) matrix of kernel weights
+      W_ij = W(r_ij, h_i),
+    + A the current adiabats of all of the particles,
+    + energies the internal energies of the particles,
+    + gamma of the gas,
+    + tol the tolerance on the Newton step in log(A),
+    + max_iter the maximum number of Newton steps,
+    + out, an array to write the new adiabats in to. It must not be A.
+    """
+    one_over_gamma = 1. / gamma
+    gamma_minus_1 = gamma - 1
+
+    A = np.asarray(A, dtype=np.float64)
+    A_pow = A**one_over_gamma
+    self_weights = weights.diagonal()
+
+    others = weights @ A_pow - self_weights * A_pow
+    target = (gamma / gamma_minus_1) * np.log(energies * gamma_minus_1)
+
+    # The Newton iteration is carried out in place in the output array.
+    log_A = np.log(A, out=out)
+
+    for _ in range(max_iter):
+        self_term = self_weights * np.exp(log_A * one_over_gamma)
+        total = others + self_term
+
+        residual = gamma * np.log(total) + log_A / gamma_minus_1 - target
+        gradient = self_term / total + 1. / gamma_minus_1
+
+        step = residual / gradient
+        log_A -= step
 
-    return fitted.x[0], A
+        if np.all(np.abs(step) < tol):
+            break
 
+    return np.exp(log_A, out=log_A)
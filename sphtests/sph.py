@@ -1,44 +1,71 @@
+import numpy as np
+
 from numpy import pi, exp, sqrt
+from scipy.sparse import csr_matrix
 
+try:
+    import cupy
+except ImportError:
+    cupy = None
 
-def gadget_kernel(r, h):
+
+def gadget_kernel_poly(factor):
     """
-    The standard GADGET Kernel, with 
+    The polynomial part of the GADGET kernel, i.e. the GADGET kernel without
+    its 4/(3 h) normalisation, with
 
-    + r the interparticle separation
-    + h the smoothing length of the particle.
+    + factor = r/h, a float or array.
     """
-    factor = r/h
     factor2 = factor * factor
-    prefactor = 4/(3 * h)
+    one_minus_factor = 1 - factor
 
-    if factor <= 0.5:
-        poly = 1 - 6 * factor2 + 6 * factor2 * factor
-    elif factor <= 1:
-        one_minus_factor = 1 - factor
-        poly = 2 * one_minus_factor * one_minus_factor * one_minus_factor
-    else:
-        poly = 0.
+    return np.where(
+        factor <= 0.5,
+        1 - 6 * factor2 + 6 * factor2 * factor,
+        np.where(
+            factor <= 1,
+            2 * one_minus_factor * one_minus_factor * one_minus_factor,
+            0.
+        )
+    )
 
-    return prefactor * poly
+
+def gadget_kernel_inv(r, inv_h):
+    """
+    The standard GADGET kernel in terms of the inverse smoothing length, so
+    that callers which already have 1/h only multiply, with
+
+    + r the interparticle separation(s), a float or array
+    + inv_h one over the smoothing length of the particle.
+    """
+    return (4/3) * inv_h * gadget_kernel_poly(r * inv_h)
+
+
+def gadget_kernel(r, h):
+    """
+    The standard GADGET Kernel, with 
+
+    + r the interparticle separation(s), a float or array
+    + h the smoothing length of the particle.
+    """
+    return gadget_kernel_inv(r, 1/h)
 
 
 def cubic_kernel(r, h):
     """
     The cubic kernel from Price, 2012, with
 
-    + r the interparticle separation
+    + r the interparticle separation(s), a float or array
     + h the smoothing length of the particle
     """
     factor = r/h
     prefactor = 2/(3 * h)
 
-    if factor < 1:
-        poly = 0.25 * (2 - factor)**3 - (1 - factor)**3
-    elif factor < 2:
-        poly = 0.25 * (2 - factor)**3
-    else:
-        poly = 0.
+    poly = np.where(
+        factor < 1,
+        0.25 * (2 - factor)**3 - (1 - factor)**3,
+        np.where(factor < 2, 0.25 * (2 - factor)**3, 0.)
+    )
 
     return prefactor * poly
 
@@ -47,29 +74,30 @@ def quintic_kernel(r, h):
     """
     The quntic kernel from Price, 2012, with
 
-    + r the interparticle separation
+    + r the interparticle separation(s), a float or array
     + h the smoothing length of the particle
     """
     q = r/h
     prefactor = 1/(120 * h)
 
-    if q < 1:
-        poly = (3 - q)**5 - 6 * (2 - q)**5 + 15 * (1 - q)**5
-    elif q < 2:
-        poly = (3 - q)**5 - 6 * (2 - q)**5
-    elif q < 3:
-        poly = (3 - q)**5
-    else:
-        poly = 0
+    poly = np.where(
+        q < 1,
+        (3 - q)**5 - 6 * (2 - q)**5 + 15 * (1 - q)**5,
+        np.where(
+            q < 2,
+            (3 - q)**5 - 6 * (2 - q)**5,
+            np.where(q < 3, (3 - q)**5, 0.)
+        )
+    )
 
     return poly * prefactor
 
 
 def gaussian_kernel(r, h):
     """
-    A perfect kernel.
+    A perfect kernel, the normalised gaussian with sigma = h/2.
 
-    + r the interparticle separation
+    + r the interparticle separation(s), a float or array
     + h the smoothing length of the particle
     """
     sigma = h/2
@@ -83,43 +111,180 @@ def tophat_kernel(r, h):
     """
     A tophat kernel. Possibly the worst kernel you can have.
 
-    + r the interparticle separation
+    + r the interparticle separation(s), a float or array
     + h the smoothing length of the particle
     """
     prefactor = 1/(2 * h)
 
-    if r/h < 1:
-        return prefactor
-    else:
-        return 0
+    return np.where(r < h, prefactor, 0.)
 
 
 def triangle_kernel(r, h):
     """
     Triangle kernel.
 
-    + r the interparticle separation
+    + r the interparticle separation(s), a float or array
     + h the smoothing length of the particle
     """
+    factor = r/h
     prefactor = 1/h
 
-    if r/h < 1:
-        return (1 - r/h) * prefactor
-    else:
-        return 0
+    return np.where(factor < 1, (1 - factor) * prefactor, 0.)
+
+
+def gadget_kernel_h_derivative(r, h):
+    """
+    The derivative of h times the GADGET kernel with respect to h, i.e.
+    d(h W)/dh, so that summing it over the neighbours gives d(h rho)/dh.
+
+    + r the interparticle separation(s), a float or array
+    + h the smoothing length of the particle.
+    """
+    factor = r/h
+    one_minus_factor = 1 - factor
+
+    # factor * dW/dfactor for the polynomial part of the kernel.
+    slope = np.where(
+        factor <= 0.5,
+        factor * factor * (18 * factor - 12),
+        np.where(
+            factor <= 1,
+            -6 * factor * one_minus_factor * one_minus_factor,
+            0.
+        )
+    )
+
+    return -4/(3 * h) * slope
+
+
+def cubic_kernel_h_derivative(r, h):
+    """
+    The derivative of h times the cubic kernel with respect to h, i.e.
+    d(h W)/dh.
+
+    + r the interparticle separation(s), a float or array
+    + h the smoothing length of the particle
+    """
+    factor = r/h
+
+    slope = np.where(
+        factor < 1,
+        factor * (3 * (1 - factor)**2 - 0.75 * (2 - factor)**2),
+        np.where(factor < 2, -0.75 * factor * (2 - factor)**2, 0.)
+    )
+
+    return -2/(3 * h) * slope
+
+
+def gaussian_kernel_h_derivative(r, h):
+    """
+    The derivative of h times the gaussian kernel with respect to h, i.e.
+    d(h W)/dh.
+
+    + r the interparticle separation
+    + h the smoothing length of the particle
+    """
+    return 4 * (r / h)**2 * gaussian_kernel(r, h)
+
+
+# d(h W)/dh for the kernels that we know it for, used by the Newton solver
+# for the smoothing lengths (gadget.solve_h_batch).
+KERNEL_H_DERIVATIVE = {
+    gadget_kernel: gadget_kernel_h_derivative,
+    cubic_kernel: cubic_kernel_h_derivative,
+    gaussian_kernel: gaussian_kernel_h_derivative,
+}
+
+
+# The radius, in units of h, beyond which each kernel is zero. Kernels that
+# are not listed here (e.g. the gaussian) are treated as having infinite
+# support, so every pair of particles is considered.
+KERNEL_SUPPORT = {
+    gadget_kernel: 1.,
+    cubic_kernel: 2.,
+    quintic_kernel: 3.,
+    tophat_kernel: 1.,
+    triangle_kernel: 1.,
+    gadget_kernel_h_derivative: 1.,
+    cubic_kernel_h_derivative: 2.,
+}
 
 
 def separations(radius, radii):
     """
     Finds the separation between all in the radii list and the radius that is
-    supplied.
+    supplied, as an array.
     """
-    return [abs(r - radius) for r in radii]
+    return np.abs(np.asarray(radii) - radius)
+
+
+def kernel_matrix(positions, h, kernel, neighbours=None):
+    """
+    The N x N matrix of kernel weights W_ij = kernel(|r_i - r_j|, h_i).
+
+    + positions are the particle positions (array),
+    + h are the smoothing lengths of the particles (array),
+    + kernel, a callable with arguments (r, h) that accepts arrays,
+    + neighbours, optionally a CSR neighbour list (indptr, indices) from
+      build_neighbour_list. If given, only the weights between neighbours
+      are evaluated and a scipy.sparse CSR matrix is returned.
+    """
+    if neighbours is not None:
+        indptr, indices = neighbours
+        rows = np.repeat(np.arange(len(positions)), np.diff(indptr))
+        weights = kernel(np.abs(positions[rows] - positions[indices]), h[rows])
+
+        return csr_matrix(
+            (weights, indices, indptr),
+            shape=(len(positions), len(positions))
+        )
+
+    separations = positions[:, None] - positions[None, :]
+    np.abs(separations, out=separations)
+
+    return kernel(separations, h[:, None])
+
+
+def build_neighbour_list(positions, radii):
+    """
+    Finds the neighbours j of every particle i, i.e. those with
+    |r_i - r_j| <= radii_i, including i itself.
+
+    In 1D the neighbours of each particle are a contiguous run of the
+    particles sorted by position, so we sort them once and find the ends of
+    each run with a binary search.
+
+    + positions are the particle positions (array),
+    + radii are the search radii of each of the particles (array).
+
+    Returns the neighbour list in CSR form (indptr, indices), such that the
+    neighbours of particle i are indices[indptr[i]:indptr[i + 1]].
+    """
+    n = len(positions)
+
+    # Pad the radii slightly so that pairs sat right on the edge of a
+    # kernel's support are not lost to rounding.
+    radii = radii * (1 + 1e-10)
+
+    order = np.argsort(positions, kind="stable")
+    sorted_positions = positions[order]
+
+    first = np.searchsorted(sorted_positions, positions - radii, side="left")
+    last = np.searchsorted(sorted_positions, positions + radii, side="right")
+    counts = last - first
+
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(counts, out=indptr[1:])
+
+    offsets = np.arange(indptr[-1]) - np.repeat(indptr[:-1], counts)
+
+    return indptr, order[np.repeat(first, counts) + offsets]
 
 
 def diff(x, y):
     """
-    Finds the sum of the absolute difference between x and y.
+    Finds the sum of the absolute difference between x and y (arrays or
+    sequences of the same length), as a Python float.
     """
-    return sum([abs(i-j) for i, j in zip(x, y)])
+    return float(np.abs(np.asarray(x) - np.asarray(y)).sum())
 
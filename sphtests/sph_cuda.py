@@ -0,0 +1,215 @@
+"""
+CUDA versions of the GADGET-kernel pairwise passes, for when there are so
+many particles that the transfer to and from a GPU is worth it. These need
+numba and a CUDA device; if either is missing CUDA_AVAILABLE is False and
+the other routines are used instead.
+
+Each thread handles one particle i. The threads of a block load the
+positions in tiles of TILE particles at a time in to shared memory, and
+every thread then sums its kernel over the tile (the usual N-body tiling).
+"""
+
+import numpy as np
+
+try:
+    from numba import cuda, float64
+    CUDA_AVAILABLE = cuda.is_available()
+except ImportError:
+    CUDA_AVAILABLE = False
+
+# The number of threads per block, and so of particles per shared tile.
+TILE = 128
+
+
+if CUDA_AVAILABLE:
+    @cuda.jit(device=True, inline=True)
+    def _gadget_poly(factor):
+        # Branches rather than masks: the padding at the end of the last
+        # tile has factor = inf, which must give exactly zero.
+        if factor <= 0.5:
+            return 1 - 6 * factor * factor + 6 * factor * factor * factor
+        elif factor <= 1:
+            return 2 * (1 - factor) * (1 - factor) * (1 - factor)
+        else:
+            return 0.
+
+
+    @cuda.jit(device=True, inline=True)
+    def _gadget_slope(factor):
+        if factor <= 0.5:
+            return factor * factor * (18 * factor - 12)
+        elif factor <= 1:
+            return -6 * factor * (1 - factor) * (1 - factor)
+        else:
+            return 0.
+
+
+    @cuda.jit
+    def _density_kernel(positions, h, out):
+        tile = cuda.shared.array(TILE, dtype=float64)
+
+        n = positions.shape[0]
+        i = cuda.grid(1)
+        thread = cuda.threadIdx.x
+
+        position = positions[min(i, n - 1)]
+        inv_h = 1. / h[min(i, n - 1)]
+        acc = 0.
+
+        for start in range(0, n, TILE):
+            j = start + thread
+            tile[thread] = positions[j] if j < n else np.inf
+            cuda.syncthreads()
+
+            for k in range(TILE):
+                acc += _gadget_poly(abs(position - tile[k]) * inv_h)
+
+            cuda.syncthreads()
+
+        if i < n:
+            out[i] = acc * 4 / 3 * inv_h
+
+
+    @cuda.jit
+    def _density_h_derivative_kernel(positions, h, density, slope):
+        tile = cuda.shared.array(TILE, dtype=float64)
+
+        n = positions.shape[0]
+        i = cuda.grid(1)
+        thread = cuda.threadIdx.x
+
+        position = positions[min(i, n - 1)]
+        inv_h = 1. / h[min(i, n - 1)]
+        acc = 0.
+        acc_slope = 0.
+
+        for start in range(0, n, TILE):
+            j = start + thread
+            tile[thread] = positions[j] if j < n else np.inf
+            cuda.syncthreads()
+
+            for k in range(TILE):
+                factor = abs(position - tile[k]) * inv_h
+                acc += _gadget_poly(factor)
+                acc_slope += _gadget_slope(factor)
+
+            cuda.syncthreads()
+
+        if i < n:
+            density[i] = acc * 4 / 3 * inv_h
+            slope[i] = -acc_slope * 4 / 3 * inv_h
+
+
+    @cuda.jit
+    def _pressure_kernel(positions, h, A_pow, gamma, out):
+        tile = cuda.shared.array(TILE, dtype=float64)
+        tile_A_pow = cuda.shared.array(TILE, dtype=float64)
+
+        n = positions.shape[0]
+        i = cuda.grid(1)
+        thread = cuda.threadIdx.x
+
+        position = positions[min(i, n - 1)]
+        inv_h = 1. / h[min(i, n - 1)]
+        acc = 0.
+
+        for start in range(0, n, TILE):
+            j = start + thread
+
+            if j < n:
+                tile[thread] = positions[j]
+                tile_A_pow[thread] = A_pow[j]
+            else:
+                tile[thread] = np.inf
+                tile_A_pow[thread] = 0.
+
+            cuda.syncthreads()
+
+            for k in range(TILE):
+                acc += _gadget_poly(abs(position - tile[k]) * inv_h) * tile_A_pow[k]
+
+            cuda.syncthreads()
+
+        if i < n:
+            out[i] = (acc * 4 / 3 * inv_h)**gamma
+
+
+def _blocks(n):
+    return (n + TILE - 1) // TILE
+
+
+def _to_device(array):
+    """
+    Arrays that are already on the device (e.g. cupy arrays) are used in
+    place; anything else is copied over as float64.
+    """
+    if hasattr(array, "__cuda_array_interface__"):
+        return cuda.as_cuda_array(array)
+
+    return cuda.to_device(np.ascontiguousarray(array, dtype=np.float64))
+
+
+def density_all(positions, h):
+    """
+    Calculates the SPH density at every particle position with the GADGET
+    kernel on the GPU.
+
+    + positions are the particle positions,
+    + h are the smoothing lengths of the particles.
+
+    Both may be host (numpy) or float64 device (e.g. cupy) arrays. The
+    densities are returned as a float64 numpy array.
+    """
+    positions = _to_device(positions)
+    h = _to_device(h)
+    out = cuda.device_array(positions.shape[0], dtype=np.float64)
+
+    _density_kernel[_blocks(positions.shape[0]), TILE](positions, h, out)
+
+    return out.copy_to_host()
+
+
+def density_h_derivative_all(positions, h):
+    """
+    As density_all, but also calculates d(h rho)/dh (see
+    sph.gadget_kernel_h_derivative) in the same pass. Returns
+    (densities, slopes) as float64 numpy arrays.
+    """
+    positions = _to_device(positions)
+    h = _to_device(h)
+    density = cuda.device_array(positions.shape[0], dtype=np.float64)
+    slope = cuda.device_array(positions.shape[0], dtype=np.float64)
+
+    _density_h_derivative_kernel[_blocks(positions.shape[0]), TILE](
+        positions, h, density, slope
+    )
+
+    return density.copy_to_host(), slope.copy_to_host()
+
+
+def pressure_all(positions, h, A, gamma=4./3.):
+    """
+    Calculates the Pressure-Entropy smoothed pressure at every particle
+    position with the GADGET kernel on the GPU.
+
+    + positions are the particle positions,
+    + h are the smoothing lengths of the particles,
+    + A are the adiabats of the particles (a host array),
+    + gamma of the gas.
+
+    The pressures are returned as a float64 numpy array.
+    """
+    # A^(1/gamma) is only needed once per particle, so it is taken on the
+    # host rather than once per tile on the device.
+    A_pow = np.asarray(A, dtype=np.float64)**(1. / gamma)
+
+    positions = _to_device(positions)
+    h = _to_device(h)
+    A_pow = _to_device(A_pow)
+    out = cuda.device_array(positions.shape[0], dtype=np.float64)
+
+    _pressure_kernel[_blocks(positions.shape[0]), TILE](
+        positions, h, A_pow, gamma, out
+    )
+
+    return out.copy_to_host()
@@ -0,0 +1,28 @@
+"""
+Loads the Cython version of the GADGET-kernel density loop (_density.pyx),
+and the C (AVX2) kernel sum for a single particle (_kernel.pyx, _kernel.c),
+compiling them with pyximport on first use. This is only a fallback for when
+numba is not installed, in which case we don't try to build them. Cython is
+also optional; if it is missing, or the extension fails to build,
+CYTHON_AVAILABLE is False.
+"""
+
+from sphtests.sph_numba import NUMBA_AVAILABLE
+
+CYTHON_AVAILABLE = False
+
+if not NUMBA_AVAILABLE:
+    try:
+        import pyximport
+
+        importers = pyximport.install(language_level=3)
+
+        try:
+            from sphtests._density import density_all
+            from sphtests._kernel import density_row
+        finally:
+            pyximport.uninstall(*importers)
+
+        CYTHON_AVAILABLE = True
+    except ImportError:
+        pass
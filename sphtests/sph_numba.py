@@ -0,0 +1,320 @@
+"""
+Numba-compiled versions of the hot pairwise loops, specialised to the GADGET
+kernel (see sph.gadget_kernel). Numba is optional; if it is not installed
+NUMBA_AVAILABLE is False and the containers fall back to the NumPy routines.
+"""
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+    prange = range
+
+
+@njit(inline="always")
+def _gadget_poly(factor):
+    """
+    The polynomial part of the GADGET kernel at factor = r/h.
+
+    Both pieces of the spline are always evaluated and then selected with
+    masks, rather than with if/else branches, so that the loops calling this
+    can be vectorised.
+    """
+    factor2 = factor * factor
+    one_minus_factor = 1 - factor
+
+    inner = 1 - 6 * factor2 + 6 * factor2 * factor
+    outer = 2 * one_minus_factor * one_minus_factor * one_minus_factor
+
+    return (factor <= 0.5) * inner + ((factor > 0.5) & (factor <= 1)) * outer
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def density_all(positions, h, out):
+    """
+    Calculates the SPH density at every particle position with the GADGET
+    kernel, fusing the separation, kernel and summation into one loop so
+    that no N x N temporary is allocated.
+
+    + positions are the particle positions,
+    + h are the smoothing lengths of the particles,
+    + out is the array that the densities are written in to.
+    """
+    n = positions.shape[0]
+
+    for i in prange(n):
+        inv_h = 1. / h[i]
+
+        # The self-contribution has r = 0, for which the polynomial is 1.
+        acc = 1.
+
+        for j in range(i):
+            acc += _gadget_poly(abs(positions[i] - positions[j]) * inv_h)
+        for j in range(i + 1, n):
+            acc += _gadget_poly(abs(positions[i] - positions[j]) * inv_h)
+
+        out[i] = acc * 4 / 3 * inv_h
+
+    return out
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def density_neighbours(positions, h, indptr, indices, out):
+    """
+    As density_all, but only summing over the neighbours of each particle,
+    given as a CSR neighbour list (see sph.build_neighbour_list).
+    """
+    n = positions.shape[0]
+
+    for i in prange(n):
+        inv_h = 1. / h[i]
+        acc = 0.
+
+        for k in range(indptr[i], indptr[i + 1]):
+            acc += _gadget_poly(abs(positions[i] - positions[indices[k]]) * inv_h)
+
+        out[i] = acc * 4 / 3 * inv_h
+
+    return out
+
+
+@njit(fastmath=True, cache=True)
+def density_row(separations, h):
+    """
+    The GADGET-kernel density of a single particle, from the separations to
+    each of the other particles and its smoothing length h.
+    """
+    inv_h = 1. / h
+    acc = 0.
+
+    for j in range(separations.shape[0]):
+        acc += _gadget_poly(separations[j] * inv_h)
+
+    return acc * 4 / 3 * inv_h
+
+
+@njit(fastmath=True, cache=True)
+def pressure_row(separations, A, h, gamma):
+    """
+    The GADGET-kernel Pressure-Entropy smoothed pressure of a single
+    particle, from the separations to and the adiabats A of each of the other
+    particles, and its smoothing length h.
+    """
+    one_over_gamma = 1. / gamma
+    inv_h = 1. / h
+    acc = 0.
+
+    for j in range(separations.shape[0]):
+        factor = separations[j] * inv_h
+
+        # Skip the pow for the particles outside of the kernel.
+        if factor < 1:
+            acc += _gadget_poly(factor) * A[j]**one_over_gamma
+
+    return (acc * 4 / 3 * inv_h)**gamma
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def pressure_all(positions, h, A, gamma, out):
+    """
+    Calculates the Pressure-Entropy smoothed pressure at every particle
+    position with the GADGET kernel, in the same fused loop as density_all.
+
+    + positions are the particle positions,
+    + h are the smoothing lengths of the particles,
+    + A are the adiabats of the particles,
+    + gamma of the gas,
+    + out is the array that the pressures are written in to.
+    """
+    n = positions.shape[0]
+    one_over_gamma = 1. / gamma
+
+    for i in prange(n):
+        inv_h = 1. / h[i]
+        acc = 0.
+
+        for j in range(n):
+            factor = abs(positions[i] - positions[j]) * inv_h
+
+            if factor < 1:
+                acc += _gadget_poly(factor) * A[j]**one_over_gamma
+
+        out[i] = (acc * 4 / 3 * inv_h)**gamma
+
+    return out
+
+
+
+@njit(inline="always")
+def _gadget_slope(factor):
+    """
+    factor times the derivative of the polynomial part of the GADGET kernel
+    at factor = r/h, selected with masks as in _gadget_poly.
+    """
+    one_minus_factor = 1 - factor
+
+    inner = factor * factor * (18 * factor - 12)
+    outer = -6 * factor * one_minus_factor * one_minus_factor
+
+    return (factor <= 0.5) * inner + ((factor > 0.5) & (factor <= 1)) * outer
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def density_h_derivative_all(positions, h, density, slope):
+    """
+    Calculates both the density and d(h rho)/dh (see
+    sph.gadget_kernel_h_derivative) at every particle position with the
+    GADGET kernel, in the same fused loop as density_all.
+
+    + positions are the particle positions,
+    + h are the smoothing lengths of the particles,
+    + density is the array that the densities are written in to,
+    + slope is the array that d(h rho)/dh is written in to.
+    """
+    n = positions.shape[0]
+
+    for i in prange(n):
+        inv_h = 1. / h[i]
+        acc = 0.
+        acc_slope = 0.
+
+        for j in range(n):
+            factor = abs(positions[i] - positions[j]) * inv_h
+            acc += _gadget_poly(factor)
+            acc_slope += _gadget_slope(factor)
+
+        density[i] = acc * 4 / 3 * inv_h
+        slope[i] = -acc_slope * 4 / 3 * inv_h
+
+    return density, slope
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def density_h_derivative_neighbours(positions, h, indptr, indices, density, slope):
+    """
+    As density_h_derivative_all, but only summing over the neighbours of
+    each particle, given as a CSR neighbour list.
+    """
+    n = positions.shape[0]
+
+    for i in prange(n):
+        inv_h = 1. / h[i]
+        acc = 0.
+        acc_slope = 0.
+
+        for k in range(indptr[i], indptr[i + 1]):
+            factor = abs(positions[i] - positions[indices[k]]) * inv_h
+            acc += _gadget_poly(factor)
+            acc_slope += _gadget_slope(factor)
+
+        density[i] = acc * 4 / 3 * inv_h
+        slope[i] = -acc_slope * 4 / 3 * inv_h
+
+    return density, slope
+
+
+@njit(inline="always")
+def _sorted_neighbour_sums(sorted_positions, k, inv_h):
+    """
+    The sums of _gadget_poly and _gadget_slope over the neighbours of the
+    particle at index k of the sorted positions, scanning outwards from it
+    until the particles leave the kernel.
+    """
+    n = sorted_positions.shape[0]
+    position = sorted_positions[k]
+
+    # The self-contribution has r = 0, for which the slope vanishes.
+    acc = 1.
+    acc_slope = 0.
+
+    j = k - 1
+    while j >= 0:
+        factor = (position - sorted_positions[j]) * inv_h
+        if factor > 1:
+            break
+        acc += _gadget_poly(factor)
+        acc_slope += _gadget_slope(factor)
+        j -= 1
+
+    j = k + 1
+    while j < n:
+        factor = (sorted_positions[j] - position) * inv_h
+        if factor > 1:
+            break
+        acc += _gadget_poly(factor)
+        acc_slope += _gadget_slope(factor)
+        j += 1
+
+    return acc, acc_slope
+
+
+@njit(parallel=True, fastmath=True, cache=True)
+def compute_all(sorted_positions, energies, eta, gamma, initial, tol, max_iter, h, density, pressure):
+    """
+    Calculates the smoothing length, density and gas pressure of every
+    particle in one pass with the GADGET kernel. Each particle's smoothing
+    length is found with its own safeguarded Newton iteration (as in
+    gadget.solve_h_batch), the density is kept from the final kernel sum,
+    and the pressure follows from it.
+
+    + sorted_positions are the particle positions, in increasing order,
+    + energies are the internal energies of the particles (in the same
+      order),
+    + eta is the smoothing length in terms of the mean interparticle
+      separation,
+    + gamma of the gas,
+    + initial is the initial guess for the smoothing lengths,
+    + tol is the tolerance on |h rho / eta - 1|,
+    + max_iter is the maximum number of iterations for each particle,
+    + h, density and pressure are the arrays that the results are written
+      in to.
+    """
+    n = sorted_positions.shape[0]
+
+    for k in prange(n):
+        this_h = initial
+        # There is no upper bracket until a step overshoots the root. This
+        # is tracked with a flag, not high = inf, because fastmath assumes
+        # that there are no infinities and drops comparisons against them.
+        low = 0.
+        high = 0.
+        bracketed = False
+
+        # The last iteration only evaluates the density at the final h.
+        for iteration in range(max_iter + 1):
+            inv_h = 1. / this_h
+            acc, acc_slope = _sorted_neighbour_sums(sorted_positions, k, inv_h)
+
+            this_density = acc * 4 / 3 * inv_h
+            neighbours = this_h * this_density
+            residual = neighbours / eta - 1
+
+            if abs(residual) < tol or iteration == max_iter:
+                break
+
+            if residual < 0:
+                low = this_h
+            else:
+                high = this_h
+                bracketed = True
+
+            slope = -acc_slope * 4 / 3 * inv_h
+            newton = this_h - (neighbours - eta) / slope if slope > 0 else -1.
+
+            if newton > low and (not bracketed or newton < high):
+                this_h = newton
+            elif not bracketed:
+                this_h = this_h * 0.5 * (1 + eta / neighbours)
+            else:
+                this_h = 0.5 * (low + high)
+
+        h[k] = this_h
+        density[k] = this_density
+        pressure[k] = (gamma - 1) * this_density * energies[k]
+
+    return h, density, pressure